@@ -4,60 +4,86 @@ Parse blast tabular formats
 
 from __future__ import division, absolute_import, print_function
 from collections import namedtuple
+from contextlib import nullcontext
+from io import BytesIO
+import mmap
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
 
+from .utils import READ_BUFFER_SIZE
+
+
+def _to_int_or_str(value):
+    '''Parse integral IDs to ints, leaving any other ID as a string'''
+    if value.isdecimal() or (value[:1] == '-' and value[1:].isdecimal()):
+        return int(value)
+    return value
+
 
 class SeqID(object):
-    _id_types = []
+    '''A parsed ``id_type|value|id_type|value`` sequence ID, with each value
+    available as an attribute named by its id type (e.g. ``seqid.gi``). A
+    bare ID with no ``|`` is available as ``seqid.id``.'''
+    __slots__ = ('_ids', )
 
     def __init__(self, seqid_str):
         # Remove whitespace and trailing |s
         seqid_str = seqid_str.strip().rstrip('|')
+        # Fast paths for the common bare ID and single 'id|value' pair
+        npipes = seqid_str.count('|')
+        if npipes == 0:
+            self._ids = {'id': seqid_str}
+            return
+        if npipes == 1:
+            id_type, _, value = seqid_str.partition('|')
+            self._ids = {id_type.strip(): _to_int_or_str(value.strip())}
+            return
         # Split into a list of id types and values
-        split = list(map(lambda x: x.strip(), seqid_str.split('|')))
+        split = seqid_str.split('|')
         # Ensure that we have a set of pairs of id_type, value
         if len(split) % 2 != 0:
             raise ValueError("Odd number of 'id|value' pairs", seqid_str)
-        # Form the list into a dict.
-        pairs = {split[i]: split[i+1] for i in range(0, len(split), 2)}
-        for id_type, value in pairs.items():
-            # Parse integral IDs to ints.
-            try:
-                value = int(value)
-            except ValueError:
-                pass
-            setattr(self, id_type, value)
-            self._id_types.append(id_type)
+        self._ids = {id_type.strip(): _to_int_or_str(value.strip())
+                     for id_type, value in zip(split[0::2], split[1::2])}
+
+    def __getattr__(self, id_type):
+        # Only called when normal lookup fails, i.e. for id types. Guard
+        # against recursion if _ids itself is unset (e.g. when unpickling).
+        if id_type == '_ids':
+            raise AttributeError(id_type)
+        try:
+            return self._ids[id_type]
+        except KeyError:
+            raise AttributeError(id_type)
 
     def __eq__(self, other):
-        if self._id_types != other._id_types:
-            return False
-        for id_type in self._id_types:
-            if getattr(self, id_type) != getattr(other, id_type):
-                return False
-        return True
+        if not isinstance(other, SeqID):
+            return NotImplemented
+        return self._ids == other._ids
 
 
 BLAST_FIELDS = {
     'qseqid': str,
     'qgi': int,
-    'qacc': float,
-    'qaccver': float,
+    'qacc': str,
+    'qaccver': str,
     'qlen': int,
     'sseqid': SeqID,
     'sallseqid': SeqID,
     'sgi': float,
-    'sallgi': float,
-    'sacc': float,
-    'saccver': float,
-    'sallacc': float,
+    'sallgi': str,
+    'sacc': str,
+    'saccver': str,
+    'sallacc': str,
     'slen': float,
     'qstart': int,
     'qend': int,
     'sstart': int,
     'send': int,
-    'qseq': float,
-    'sseq': float,
+    'qseq': str,
+    'sseq': str,
     'evalue': float,
     'bitscore': float,
     'score': float,
@@ -69,18 +95,18 @@ BLAST_FIELDS = {
     'gapopen': int,
     'gaps': float,
     'ppos': float,
-    'frames': float,
+    'frames': str,
     'qframe': float,
     'sframe': float,
-    'btop': float,
-    'staxids': float,
-    'sscinames': float,
-    'scomnames': float,
-    'sblastnames': float,
-    'sskingdoms': float,
-    'stitle': float,
-    'salltitles': float,
-    'sstrand': float,
+    'btop': str,
+    'staxids': str,
+    'sscinames': str,
+    'scomnames': str,
+    'sblastnames': str,
+    'sskingdoms': str,
+    'stitle': str,
+    'salltitles': str,
+    'sstrand': str,
     'qcovs': float,
     'qcovhsp': float,
 }
@@ -102,78 +128,245 @@ DEFAULT_BLAST_FIELDS = [
 ]
 
 
+# Map the python types in BLAST_FIELDS to the dtypes pandas should parse each
+# column as. Anything else (i.e. SeqID) is read as a plain string, then
+# passed through its BLAST_FIELDS type.
+BLAST_DTYPES = {
+    int: 'int64',
+    float: 'float64',
+    str: 'object',
+}
+
+
+def _blast_dtypes(fields):
+    '''The dtype pandas should parse each of ``fields`` as. Fields not in
+    BLAST_FIELDS are left for pandas to infer.'''
+    return {f: BLAST_DTYPES.get(BLAST_FIELDS[f], 'object') for f in fields
+            if f in BLAST_FIELDS}
+
+
+def _read_blast_table(fh, fields, dtype, chunksize=None):
+    # round_trip float parsing gives identical values to python's float()
+    return pd.read_csv(fh, sep='\t', names=fields, dtype=dtype,
+                       chunksize=chunksize, engine='c', na_filter=False,
+                       float_precision='round_trip')
+
+
+def _parse_blast_span(span):
+    '''Parse the rows between two byte offsets of a blast table, for
+    ``BlastFile.parallel_iter()``'''
+    filename, start, end, fields, dtype = span
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        buf = fh.read(end - start)
+    return _read_blast_table(BytesIO(buf), fields, dtype)
+
+
+def _compile_record_builder(record, fields):
+    '''Generate a function which builds ``record``s from the column lists of
+    a parsed chunk, with each column's python converter (if any) inlined.
+
+    For fields ``qseqid, sseqid, evalue`` the generated function is::
+
+        def build(columns):
+            c0, c1, c2 = columns
+            return map(record, c0, map(convert1, c1), c2)
+    '''
+    namespace = {'record': record}
+    args = []
+    for i, field in enumerate(fields):
+        convert = BLAST_FIELDS[field]
+        if convert in BLAST_DTYPES:
+            args.append('c{}'.format(i))
+        else:
+            namespace['convert{}'.format(i)] = convert
+            args.append('map(convert{0}, c{0})'.format(i))
+    source = '\n'.join([
+        'def build(columns):',
+        '    {}, = columns'.format(', '.join('c{}'.format(i)
+                                             for i in range(len(fields)))),
+        '    return map(record, {})'.format(', '.join(args)),
+    ])
+    exec(compile(source, '<BlastRecord builder>', 'exec'), namespace)
+    return namespace['build']
+
+
 class BlastFile(object):
-    '''Returns a BlastRecord for each record in ``filename``'''
+    '''Returns a BlastRecord for each record in ``filename``
+
+    The table is parsed ``chunksize`` rows at a time by pandas' C parser, and
+    records are yielded from each chunk in turn. Callers wanting columnar
+    data should use ``iter_chunks()`` or ``to_dataframe()``, which skip
+    creating a record per row.
+    '''
 
     fh = None
 
-    def __init__(self, filename, fields=DEFAULT_BLAST_FIELDS):
+    def __init__(self, filename, fields=DEFAULT_BLAST_FIELDS, chunksize=10000):
         self.record = namedtuple("BlastRecord", fields)
         self.filename = filename
-        self.fh = open(self.filename)
+        self.fh = open(self.filename, buffering=READ_BUFFER_SIZE)
         self.fields = fields
+        self.chunksize = chunksize
+        self._dtype = _blast_dtypes(fields)
+        # Columns pandas can't parse itself are converted by python after
+        # parsing, by a builder function generated for this set of fields.
+        self._build_records = _compile_record_builder(self.record, fields)
+        self._open_reader()
+
+    def _open_reader(self):
+        self._reader = _read_blast_table(self.fh, self.fields, self._dtype,
+                                         chunksize=self.chunksize)
+        self._records = iter(())
 
     def __iter__(self):
         if self.fh:
             self.fh.seek(0)
+            self._open_reader()
         return self
 
     def __next__(self):
-        line = self.fh.readline().strip()
-        if not line:
-            raise StopIteration()
-        values = line.split('\t')
-        # Convert each value given the blast field dictionary.
-        for i, field in enumerate(self.fields):
-            values[i] = BLAST_FIELDS[field](values[i])
-        return self.record(*values)
+        while True:
+            try:
+                return next(self._records)
+            except StopIteration:
+                pass
+            # Refill from the next chunk, or raise StopIteration at EOF
+            chunk = next(self._reader)
+            # Convert whole columns to python objects at once, rather than
+            # boxing each value of each row as it is accessed.
+            columns = [chunk[f].to_numpy().tolist() for f in self.fields]
+            self._records = self._build_records(columns)
+
+    def iter_chunks(self, chunksize=None):
+        '''Yield a ``pandas.DataFrame`` of each ``chunksize`` rows of the
+        table (by default, this BlastFile's ``chunksize``). SeqID columns are
+        left as strings.
+        '''
+        if chunksize is None:
+            chunksize = self.chunksize
+        with open(self.filename) as fh:
+            for chunk in _read_blast_table(fh, self.fields, self._dtype,
+                                           chunksize=chunksize):
+                yield chunk
+
+    def to_dataframe(self):
+        '''Parse the whole table into a single ``pandas.DataFrame``. SeqID
+        columns are left as strings.
+        '''
+        with open(self.filename) as fh:
+            return _read_blast_table(fh, self.fields, self._dtype)
+
+    def parallel_iter(self, nworkers=None):
+        '''Parse the table in ``nworkers`` processes, yielding a
+        ``pandas.DataFrame`` of each worker's share of rows, in file order.
+
+        The file is split into byte ranges at the newline following each
+        of ``nworkers`` equally spaced offsets. SeqID columns are left as
+        strings.
+        '''
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        with open(self.filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if not size:
+                return
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                bounds = [0]
+                for i in range(1, nworkers):
+                    start = max(size * i // nworkers, bounds[-1])
+                    end = mm.find(b'\n', start) + 1
+                    if end <= 0:
+                        break
+                    bounds.append(end)
+                bounds.append(size)
+            finally:
+                mm.close()
+        spans = [(self.filename, start, end, self.fields, self._dtype)
+                 for start, end in zip(bounds[:-1], bounds[1:])
+                 if end > start]
+        pool = multiprocessing.Pool(min(nworkers, len(spans)))
+        try:
+            for df in pool.imap(_parse_blast_span, spans):
+                yield df
+        finally:
+            pool.terminate()
 
     def __enter__(self):
-        pass
+        # Hint that we will read the whole file in order, so the kernel reads
+        # ahead aggressively. Not all platforms have posix_fadvise.
+        try:
+            os.posix_fadvise(self.fh.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        return self
 
-    def __exit__(self):
+    def __exit__(self, exc_type, exc_value, traceback):
         if self.fh:
             self.fh.close()
 
 
+def _concat_group(frames):
+    '''Join the slices of one group, skipping the copy when the group lies
+    within a single chunk'''
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames)
+
+
 def parse_blast_groupby(filename, group_by=['qseqid', ],
                         fields=DEFAULT_BLAST_FIELDS, filter='',
                         chunksize=5000):
     '''Iterate over a blast table, parsing each query's hits into a separate
     pandas data frame. Assumes the table is sorted by query sequence ID.
 
-    Field names must be specified if a format other than the standard '-outfmt
-    6' tabular format is being parsed. An optional filter on table columns may
-    be provided, e.g 'evalue < 1e-10'. See ``pandas.DataFrame.query()`` for
-    more details on filtering.
+    ``filename`` may be a path or an open file. Field names must be specified
+    if a format other than the standard '-outfmt 6' tabular format is being
+    parsed. An optional filter on table columns may be provided, e.g 'evalue
+    < 1e-10'. See ``pandas.DataFrame.query()`` for more details on filtering.
     '''
 
     # Algorithm:
-    #  - keep a dictonary of unfinished queries.
-    #  - for each chunk, for all unfinished queries, check if they don't appear
-    #    in the current chunk, if they don't, yield them.
-    #  - otherwise, append or add the current queries to the dict of unfinished
-    #    queries.
-    #  - finally, return all query: dataframe pairs.
-
-    lastgroups = {}
-    for chunk in pd.read_table(filename, names=fields, chunksize=chunksize):
-        if filter:
-            chunk = chunk.query(filter)
-        groups = {k: df for k, df in chunk.groupby(group_by)}
-        # To avoid changing dict len when popping in a for loop, we keep track
-        # of things we have yeild-ed and therefore want to pop outside of the
-        # loop (in the next one).
-        to_pop = []
-        for key in lastgroups:
-            if key in groups:
-                lastgroups[key] = pd.concat((lastgroups[key], df))
-            else:
-                to_pop.append(key)
-                yield key, lastgroups[key]
-        for key in to_pop:
-            lastgroups.pop(key)
-        for key, df in groups.items():
-            lastgroups[key] = df
-    for key, df in lastgroups.items():
-        yield key, df
+    #  - the table is sorted, so each query's hits are a contiguous run of
+    #    rows. Within each chunk, find the rows where any group_by column
+    #    differs from the row before it; these are the group boundaries.
+    #  - slice the chunk at each boundary. The last group of a chunk may
+    #    continue into the next chunk, so keep a list of its pending slices
+    #    until the key changes, then concatenate and yield them at once. Most
+    #    groups fit within one chunk, and are yielded without a copy.
+    #  - finally, yield the last pending group.
+
+    pending_key = None
+    pending = []
+    # Read paths through a large buffer, and open files as they are
+    if isinstance(filename, (str, os.PathLike)):
+        source = open(filename, buffering=READ_BUFFER_SIZE)
+    else:
+        source = nullcontext(filename)
+    with source as fh:
+        chunks = _read_blast_table(fh, fields, _blast_dtypes(fields),
+                                   chunksize=chunksize)
+        for chunk in chunks:
+            if filter:
+                chunk = chunk.query(filter)
+            if not len(chunk):
+                continue
+            columns = [chunk[col].to_numpy() for col in group_by]
+            changed = np.zeros(len(chunk) - 1, dtype=bool)
+            for ids in columns:
+                changed |= ids[1:] != ids[:-1]
+            bounds = ([0] + (np.flatnonzero(changed) + 1).tolist() +
+                      [len(chunk)])
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                key = tuple(ids[start] for ids in columns)
+                if len(key) == 1:
+                    key = key[0]
+                if pending and key != pending_key:
+                    yield pending_key, _concat_group(pending)
+                    pending = []
+                pending_key = key
+                pending.append(chunk.iloc[start:end])
+    if pending:
+        yield pending_key, _concat_group(pending)
@@ -3,15 +3,25 @@ NCBI Taxonomy database handling.
 """
 
 from __future__ import absolute_import, division, print_function
+import codecs
 from collections import OrderedDict
-import gzip
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from itertools import chain, islice
+import csv
+import io
 import json
+import operator
 import os
 from os import path
 import sqlite3
 import tarfile
+import threading
 
+import numpy as np
+import pandas as pd
 import requests
+from six.moves import queue
 
 from .utils import (
     download_file,
@@ -19,7 +29,9 @@ from .utils import (
     get_data_file,
     get_logger,
     md5sum,
+    open_gzip,
     read_remote_file,
+    READ_BUFFER_SIZE,
 )
 
 
@@ -30,7 +42,15 @@ __all__ = [
 ]
 
 
-DB_VERSION = 1
+DB_VERSION = 3
+
+# Each taxon's ancestors are stored as a packed array of this dtype
+LINEAGE_DTYPE = np.dtype('<i4')
+
+# Number of recent GI and lineage lookups each NCBITaxonomyDB caches. Blast
+# hits mostly fall within a small set of sequences and taxa.
+GI_CACHE_SIZE = 1000000
+LINEAGE_CACHE_SIZE = 100000
 
 ALL_RANKS = [  # TODO: sort this by some logical order
     'no rank',
@@ -76,11 +96,121 @@ DEFAULT_RANKS = [
 
 LOG = get_logger()
 
+
+def _read_dmp(fh, fields):
+    '''Read an NCBI taxdump .dmp file into a DataFrame.
+
+    ``fields`` is a list of ``(name, index, dtype)`` for each field to read.
+    Fields are delimited by '\t|\t', so splitting on tabs alone puts field
+    ``i`` in column ``2 * i``, which lets pandas' C parser do the work.
+    '''
+    columns = {2 * index: name for name, index, dtype in fields}
+    dtype = {2 * index: dtype for name, index, dtype in fields}
+    df = pd.read_csv(fh, sep='\t', header=None, usecols=list(columns),
+                     dtype=dtype, quoting=csv.QUOTE_NONE, na_filter=False,
+                     engine='c')
+    return df.rename(columns=columns)
+
+
+def _insert_rows(cursor, table, ncols, rows, max_vars=999):
+    '''Insert ``rows`` into ``table`` with multi-row ``INSERT`` statements,
+    of as many rows as fit in sqlite's limit of ``max_vars`` parameters.
+
+    Each statement runs once for many rows, rather than once per row as with
+    ``executemany()``.
+    '''
+    nrows = max_vars // ncols
+    values = '({})'.format(', '.join('?' * ncols))
+    sql = "INSERT INTO {} VALUES {}".format(table, ', '.join([values] * nrows))
+    params = chain.from_iterable(rows)
+    while True:
+        batch = list(islice(params, nrows * ncols))
+        if len(batch) < nrows * ncols:
+            break
+        cursor.execute(sql, batch)
+    if batch:
+        tail = ', '.join([values] * (len(batch) // ncols))
+        cursor.execute("INSERT INTO {} VALUES {}".format(table, tail), batch)
+
+
+def _prefetch(iterables, maxsize=4):
+    '''Iterate over each of ``iterables`` in its own background thread,
+    yielding items from any of them as they are ready. Up to ``maxsize`` items
+    are kept ready ahead of the consumer.
+
+    Decompressing and parsing in pandas and inserting into sqlite both mostly
+    release the GIL, so this overlaps the two. Any exception raised by an
+    iterable is re-raised in the consumer. Once the consumer stops, by error
+    or by closing this generator, the threads stop and close their iterables.
+    '''
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Time out now and then, so a full queue can't block a thread after
+        # the consumer has gone.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as exc:
+            put((None, exc))
+            return
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        put((done, None))
+
+    threads = [threading.Thread(target=produce, args=(iterable, ))
+               for iterable in iterables]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = len(threads)
+    try:
+        while running:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is done:
+                running -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _read_gi_taxid(sect):
+    '''Yield (sect, DataFrame) of each million rows of a gi_taxid dump'''
+    filename = get_data_file('gi_taxid_{}.dmp.gz').format(sect)
+    LOG.debug("Loading 'gi_taxid_%s.dmp.gz'", sect)
+    with open_gzip(filename) as fh:
+        chunks = pd.read_csv(fh, sep=r'\s+', header=None,
+                             names=['gi', 'taxid'], dtype='int64',
+                             chunksize=1000000, engine='c')
+        for chunk in chunks:
+            yield sect, chunk
+
+
 class NCBITaxonomyDB(object):
     '''
     Provides a local transparent connector to the NCBI taxonomy database.
     '''
     _db = None
+    _cursor = None
+    _merges = None
     metadata = {
         "db_version": DB_VERSION,
         "db_complete": False,
@@ -89,12 +219,31 @@ class NCBITaxonomyDB(object):
         "gi_taxid_prot_md5": '',
     }
 
+    # SQL for the per-hit lookups, executed on a single reused cursor.
+    _METADATA_SQL = "SELECT key, value FROM meta"
+    _MERGES_SQL = "SELECT oldid, newid FROM merges"
+    _GI_TAXID_SQL = "SELECT taxid FROM sequences WHERE gi = ?"
+    # Formatted with a placeholder for each GI in gis_to_taxids()
+    _GI_TAXIDS_SQL = "SELECT gi, taxid FROM sequences WHERE gi IN ({})"
+    _ANCESTORS_SQL = "SELECT ancestors FROM lineages WHERE taxid = ?"
+    # Formatted with a placeholder for each taxid in _lineage()
+    _TAXA_SQL = "SELECT taxid, rank, name FROM taxa WHERE taxid IN ({})"
 
     def __init__(self, dbfile=None):
 
         self._dbfile = dbfile
         if not self._dbfile:
             self._dbfile = get_data_file('taxa.sqlite')
+        # (rank, name) of each taxon seen in a lineage. Most lineages share
+        # their upper levels, so after a few lookups most of each lineage is
+        # found here.
+        self._taxa = {}
+        # Cache the hot lookups per instance, as caching the methods of the
+        # class would keep every instance alive.
+        self.gi_to_taxid = lru_cache(GI_CACHE_SIZE)(self.gi_to_taxid)
+        self._lineage = lru_cache(LINEAGE_CACHE_SIZE)(self._lineage)
+        self._ranked_lineage = lru_cache(LINEAGE_CACHE_SIZE)(
+            self._ranked_lineage)
 
         self._connect()
 
@@ -103,9 +252,11 @@ class NCBITaxonomyDB(object):
             # No-op if we have a db handle
             return
         try:
-            self._db = sqlite3.connect(self._dbfile)
-            with open(self._dbfile + '.info') as fh:
-                self.metadata = json.load(fh)
+            self._open_db()
+            self.metadata = {
+                key: json.loads(value)
+                for key, value in self._db.execute(self._METADATA_SQL)
+            }
             if self.metadata["db_version"] != DB_VERSION:
                 raise ValueError("Invalid DB version")
             if not self.metadata["db_complete"]:
@@ -113,56 +264,122 @@ class NCBITaxonomyDB(object):
             LOG.debug('Taxonomy DB loaded successfully')
         except Exception:
             LOG.info('Taxonomy DB not valid, (re-)creating')
+            # Keep any checksums of the dump files from the old DB, but not
+            # its version or completeness.
+            self.metadata = dict(NCBITaxonomyDB.metadata, **{
+                key: value for key, value in self.metadata.items()
+                if key.endswith(('_md5', '_md5_stat'))
+            })
             self._wipe_db()
             self._create_db()
 
+    def _open_db(self):
+        '''Opens a connection to the sqlite DB, tuned for fast lookups'''
+        self._db = sqlite3.connect(self._dbfile)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        # Negative cache sizes are in KiB, i.e. this is 200MiB
+        self._db.execute("PRAGMA cache_size = -200000")
+        self._db.execute("PRAGMA mmap_size = {}".format(1 << 32))
+        self._db.execute("PRAGMA temp_store = MEMORY")
+        self._cursor = self._db.cursor()
+
+    @contextmanager
+    def _bulk_load(self):
+        '''Run a bulk load into the database as a single transaction.
+
+        Nothing else can use the database until it is complete, so don't sync
+        or journal to disk during the load. An interrupted load leaves the DB
+        marked incomplete, and it is rebuilt on the next connection.
+        '''
+        synchronous, = self._db.execute("PRAGMA synchronous").fetchone()
+        journal_mode, = self._db.execute("PRAGMA journal_mode").fetchone()
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("PRAGMA journal_mode = MEMORY")
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except Exception:
+            self._db.rollback()
+            raise
+        else:
+            self._db.commit()
+        finally:
+            self._db.execute("PRAGMA journal_mode = {}".format(journal_mode))
+            self._db.execute("PRAGMA synchronous = {}".format(synchronous))
+
     def _write_metadata(self):
-        with open(self._dbfile + '.info', 'w') as fh:
-            json.dump(self.metadata, fh)
+        # Values are stored as JSON, to keep their types
+        self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                             ((key, json.dumps(value))
+                              for key, value in self.metadata.items()))
+        self._db.commit()
 
     def _wipe_db(self):
         LOG.debug('Wiping sqlite taxonomy database')
-        try:
-            os.remove(self._dbfile)
-        except Exception:
-            pass
-        try:
-            os.remove(self._dbfile + '.info')
-        except Exception:
-            pass
+        if self._db:
+            self._db.close()
+            self._db = None
+        # '.info' held the metadata of DBs before it moved into the DB
+        for suffix in ['', '-wal', '-shm', '.info']:
+            try:
+                os.remove(self._dbfile + suffix)
+            except Exception:
+                pass
 
     def _create_db(self):
         """Creates the structure in the sqlite DB and opens a connection to the
         database."""
         LOG.debug('Creating sqlite taxonomy database')
-        self._db = sqlite3.connect(self._dbfile)
+        self._open_db()
         c = self._db.cursor()
+        c.execute("""CREATE TABLE meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                        );""")
         c.execute("""CREATE TABLE merges (
                         oldid INTEGER PRIMARY KEY,
                         newid INTEGER
                         );""")
         c.execute("""CREATE TABLE sequences (
                         gi INTEGER PRIMARY KEY,
-                        taxid TEXT,
-                        FOREIGN KEY (taxid) REFERENCES taxa(taxid)
+                        taxid INTEGER
                         );""")
         c.execute("""CREATE TABLE taxa (
                         taxid INTEGER PRIMARY KEY,
                         name TEXT,
                         rank TEXT
                         );""")
-        c.execute("""CREATE TABLE parents (
-                        taxid INTEGER,
-                        parent INTEGER,
-                        level INTEGER,
-                        FOREIGN KEY (taxid) REFERENCES taxa(taxid),
-                        FOREIGN KEY (parent) REFERENCES taxa(taxid)
+        c.execute("""CREATE TABLE lineages (
+                        taxid INTEGER PRIMARY KEY,
+                        ancestors BLOB,
+                        FOREIGN KEY (taxid) REFERENCES taxa(taxid)
                         );""")
-        c.execute("CREATE INDEX parents_taxid ON parents (taxid)")
         self._db.commit()
         self._write_metadata()
         self._load_db()
 
+    def _update_md5(self, filename, hash_key):
+        '''Store the md5 of a local data file in metadata under ``hash_key``,
+        or '' if there is no such file.
+
+        The file's size and modification time are stored with it, and if they
+        are unchanged the stored md5 is trusted, rather than rereading the
+        whole file.
+        '''
+        stat_key = hash_key + '_stat'
+        if not path.exists(filename):
+            self.metadata[hash_key] = ''
+            return
+        stat = os.stat(filename)
+        file_stat = [stat.st_size, stat.st_mtime_ns]
+        if self.metadata.get(hash_key) and \
+                self.metadata.get(stat_key) == file_stat:
+            LOG.debug("%s unchanged, using stored checksum", filename)
+            return
+        LOG.debug("%s found, calculating checksum", filename)
+        self.metadata[hash_key] = md5sum(filename)
+        self.metadata[stat_key] = file_stat
+
     def _get_taxdump_file(self):
         '''Helper to download the NCBI taxdump tarball if we need it'''
         taxdump_url = 'http://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz'
@@ -170,14 +387,11 @@ class NCBITaxonomyDB(object):
 
         taxdump_remote_hash = read_remote_file(taxdump_url + '.md5').split()[0]
 
-        if path.exists(taxdump_file):
-            LOG.debug("Taxdump file found, calculating checksum")
-            self.metadata['taxdump_md5'] = md5sum(taxdump_file)
-
-        while taxdump_remote_hash != self.metadata.get('taxdump_md5', ''):
+        self._update_md5(taxdump_file, 'taxdump_md5')
+        while taxdump_remote_hash != self.metadata['taxdump_md5']:
             LOG.info("Taxdump file out of date, downloading it")
             download_file(taxdump_url, taxdump_file)
-            self.metadata['taxdump_md5'] = md5sum(taxdump_file)
+            self._update_md5(taxdump_file, 'taxdump_md5')
 
         LOG.debug("We have a valid Taxdump file")
 
@@ -193,16 +407,11 @@ class NCBITaxonomyDB(object):
             sect_remote_hash = read_remote_file(sect_url + '.md5').split()[0]
             sect_file = gi_tax_file.format(sect=sect)
             sect_hash_key = 'gi_taxid_{}_md5'.format(sect)
-            sect_local_hash = self.metadata.get(sect_hash_key, '')
-
-            if path.exists(sect_file):
-                LOG.debug("GI to tax %s file found, calculating checksum",
-                          sect)
-                self.metadata[sect_hash_key] = md5sum(sect_file)
 
+            self._update_md5(sect_file, sect_hash_key)
             while self.metadata[sect_hash_key] != sect_remote_hash:
                 download_file(sect_url, sect_file)
-                self.metadata[sect_hash_key] = md5sum(sect_file)
+                self._update_md5(sect_file, sect_hash_key)
             LOG.debug("We have a valid gi_taxid_%s file", sect)
         self._write_metadata()
 
@@ -213,149 +422,182 @@ class NCBITaxonomyDB(object):
         self._get_gitax_file()
 
         taxdump_file = get_data_file('taxdump.tar.gz')
-        tar = tarfile.open(taxdump_file)
         cursor = self._db.cursor()
 
-        def dmpfile(filename):
-            with tar.extractfile(filename) as fh:
-                for line in fh:
-                    line = line.decode("utf-8")
-                    fields = [x.strip() for x in line.strip('\n|').split('\t|\t')]
-                    yield fields
-
-        names = {}
-        nodes = {}
-        ranks = {}
-        merges = {}
-
-        for taxon in dmpfile('names.dmp'):
-            taxid = int(taxon[0])
-            name = taxon[1]
-            nameclass = taxon[3]
-            if nameclass == "scientific name":
-                names[taxid] = name
-
-        for taxon in dmpfile('nodes.dmp'):
-            taxid = int(taxon[0])
-            parent = int(taxon[1])
-            rank = taxon[2]
-            nodes[taxid] = parent
-            ranks[taxid] = rank
-
-        for ids in dmpfile("merged.dmp"):
-            oldid, newid = map(int, ids)
-            cursor.execute("INSERT INTO merges VALUES (?, ?)", (oldid, newid))
+        dmp_fields = {
+            'names.dmp': [('taxid', 0, 'int64'),
+                          ('name', 1, 'object'),
+                          ('nameclass', 3, 'object')],
+            'nodes.dmp': [('taxid', 0, 'int64'),
+                          ('parent', 1, 'int64'),
+                          ('rank', 2, 'object')],
+            'merged.dmp': [('oldid', 0, 'int64'),
+                           ('newid', 1, 'int64')],
+        }
+        dmps = {}
+        # Read the tarball as a stream, taking each file we need as it comes.
+        with open_gzip(taxdump_file) as gz, \
+                tarfile.open(fileobj=gz, mode='r|',
+                             bufsize=READ_BUFFER_SIZE) as tar:
+            for member in tar:
+                if member.name in dmp_fields:
+                    # Members of a streamed tarfile don't support seekable(),
+                    # so pandas can't wrap them as text itself. They are read
+                    # through a small buffer by default.
+                    member_fh = tar.extractfile(member)
+                    with io.BufferedReader(member_fh, READ_BUFFER_SIZE) as fh:
+                        dmps[member.name] = _read_dmp(
+                            codecs.getreader('utf-8')(fh),
+                            dmp_fields[member.name]
+                        )
 
-        LOG.debug("Loaded data files")
+        names = dmps['names.dmp']
+        names = names[names.nameclass == "scientific name"]
+        nodes = dmps['nodes.dmp']
+        merges = dmps['merged.dmp']
 
-        # The tree is stored a a dict of {taxid: [taxid, parent, ..., 1]}
-        # for each parent in the tree to the root.
-        # Start with the root node.
-        tree = {1: [], }
-        for taxon, parent in nodes.items():
-            if parent in tree and taxon != 1:
-                tree[taxon] = [taxon] + tree[parent]
-            else:
-                subtree = [taxon, parent]
-                # A new list for just the new section of the tree
-                newtree = [taxon, parent]
-                thisid = parent
-                verb = False
-                while True:
-                    if thisid in tree:
-                        # This will eventually be true, so long as everything
-                        # is rooted at taxid 1
-                        subtree.extend(tree[thisid])
-                        break
-                    thisparent = nodes[thisid]
-                    subtree.append(thisparent)
-                    newtree.append(thisparent)
-
-                    thisid = thisparent
-                # Add the new section of the tree
-                for i in range(len(newtree)):
-                    thisid = subtree[i]
-                    heirarchy = subtree[i + 1:]
-                    tree[thisid] = heirarchy
-
-        LOG.debug("Created taxa tree")
-
-        for i, (taxid, parents) in enumerate(tree.items()):
-            parent_items = [(taxid, par, i) for i, par in enumerate(parents)]
-            cursor.executemany("INSERT INTO parents VALUES (?, ?, ?)",
-                               parent_items)
-            cursor.execute("INSERT INTO taxa VALUES (?, ?, ?)",
-                           (taxid, names[taxid], ranks[taxid]))
-            if i % 100000 == 0:
-                LOG.debug("Inserted %0.2fM taxa", i / 1000000)
-
-        LOG.debug("Created taxa database (with %d records)", len(tree))
-        self._db.commit()
+        with self._bulk_load():
+            self._load_taxa(cursor, names, nodes, merges)
+        LOG.debug("Created taxa database (with %d records)", len(nodes))
 
         LOG.debug("Creating sequence GI to taxid database")
-        for sect in ['prot', 'nucl']:
-            filename = get_data_file('gi_taxid_{}.dmp.gz').format(sect)
-            LOG.debug("Loading 'gi_taxid_%s.dmp.gz'", sect)
-            with gzip.open(filename) as fh:
-                pairs = []
-                for i, line in enumerate(fh):
-                    gi, taxid = map(int, line.strip().split())
-                    pairs.append((gi, taxid))
-                    if i % 1000000 == 0:
-                        cursor.executemany(
-                            "INSERT INTO sequences VALUES (?, ?)",
-                            pairs
-                        )
-                        pairs[:] = []
-                        LOG.debug("%0.0fM %s GIs loaded", i/1000000, sect)
-            self._db.commit()
+        with self._bulk_load():
+            self._load_sequences(cursor)
         LOG.debug("Finished loading sequences ID to taxid database")
         LOG.info("Loaded taxonomy and sequence data into database")
         self.metadata["db_complete"] = True
         self._write_metadata()
 
+    def _load_taxa(self, cursor, names, nodes, merges):
+        _insert_rows(cursor, 'merges', 2,
+                     zip(merges.oldid.tolist(), merges.newid.tolist()))
+
+        taxa = nodes.merge(names[['taxid', 'name']], on='taxid', how='left')
+        _insert_rows(cursor, 'taxa', 3,
+                     zip(taxa.taxid.tolist(), taxa.name.tolist(),
+                         taxa['rank'].tolist()))
+
+        LOG.debug("Loaded data files")
+
+        # Store every taxon's ancestors as a packed array, from the taxon
+        # itself to the root (taxid 1). Using an array of each taxon's parent,
+        # all taxa are walked up the tree together, one level per iteration:
+        # once to find each lineage's length, then again to fill in each
+        # lineage's slice of a single flat array of all lineages.
+        taxids = nodes.taxid.to_numpy(dtype=LINEAGE_DTYPE)
+        parents = nodes.parent.to_numpy(dtype=LINEAGE_DTYPE)
+        parent = np.zeros(max(taxids.max(), parents.max()) + 1,
+                          dtype=LINEAGE_DTYPE)
+        parent[taxids] = parents
+        # The root is its own parent. Walking past it (or to an unknown
+        # taxon) gives 0, which ends that taxon's walk.
+        parent[1] = 0
+
+        def walk():
+            index = np.arange(len(taxids))
+            ancestors = taxids
+            while len(index):
+                yield index, ancestors
+                ancestors = parent[ancestors]
+                unfinished = ancestors != 0
+                index = index[unfinished]
+                ancestors = ancestors[unfinished]
+
+        depth = np.zeros(len(taxids), dtype=np.int64)
+        for index, _ in walk():
+            depth[index] += 1
+        offsets = np.zeros(len(taxids) + 1, dtype=np.int64)
+        np.cumsum(depth, out=offsets[1:])
+        lineages = np.empty(offsets[-1], dtype=LINEAGE_DTYPE)
+        for level, (index, ancestors) in enumerate(walk()):
+            lineages[offsets[index] + level] = ancestors
+        _insert_rows(
+            cursor, 'lineages', 2,
+            ((taxid, sqlite3.Binary(lineages[start:end].tobytes()))
+             for taxid, start, end in zip(taxids.tolist(),
+                                          offsets[:-1].tolist(),
+                                          offsets[1:].tolist()))
+        )
+        LOG.debug("Created taxa tree (%d levels deep)", depth.max())
+
+    def _load_sequences(self, cursor):
+        # The prot and nucl dumps are read and parsed concurrently, while
+        # their rows are inserted by this thread (sqlite connections can't be
+        # shared between threads).
+        sects = ['prot', 'nucl']
+        loaded = dict.fromkeys(sects, 0)
+        chunks = _prefetch([_read_gi_taxid(sect) for sect in sects])
+        with closing(chunks):
+            for sect, chunk in chunks:
+                _insert_rows(cursor, 'sequences', 2,
+                             zip(chunk.gi.tolist(), chunk.taxid.tolist()))
+                loaded[sect] += 1
+                LOG.debug("%dM %s GIs loaded", loaded[sect], sect)
+
     def get_merged_taxid(self, taxid):
         '''Convert an old taxid to it's up-to-date ID, or return the orginal
         taxid'''
-        qry = self._db.execute('''SELECT newid FROM merges
-                                 WHERE oldid = ?''', (taxid, ))
-        newid = qry.fetchone()
-        if newid:
-            return newid
-        return taxid
+        # The merges table is small, so is read into a dict on first use
+        if self._merges is None:
+            self._merges = dict(self._cursor.execute(self._MERGES_SQL))
+        return self._merges.get(taxid, taxid)
 
     def gi_to_taxid(self, gi):
-        # Ensure GI is an integer
-        gi = int(gi)
-
-        c = self._db.cursor()
-        qry = c.execute("SELECT taxid FROM sequences WHERE gi = ?", (gi,))
-        res = qry.fetchone()
+        # Ensure GI is a python int: sqlite3 binds numpy integers as BLOBs,
+        # which match no GI. Looking up gi, the table's rowid, fetches the
+        # taxid too, without an index.
+        gi = operator.index(gi)
+        res = self._cursor.execute(self._GI_TAXID_SQL, (gi, )).fetchone()
         if not res:
             raise KeyError("GI {} not found in database".format(gi))
         return res[0]
 
+    def _lineage(self, taxid):
+        '''Returns a list of (taxid, rank, name) for a taxon and each of its
+        ancestors, up to the root. The list is cached, so must not be
+        modified.'''
+        row = self._cursor.execute(self._ANCESTORS_SQL, (taxid, )).fetchone()
+        if not row:
+            return []
+        ancestors = np.frombuffer(row[0], dtype=LINEAGE_DTYPE).tolist()
+        missing = [t for t in ancestors if t not in self._taxa]
+        if missing:
+            sql = self._TAXA_SQL.format(', '.join('?' * len(missing)))
+            for parent, rank, name in self._cursor.execute(sql, missing):
+                self._taxa[parent] = (rank, name)
+        return [(t, ) + self._taxa[t] for t in ancestors if t in self._taxa]
+
+    def gis_to_taxids(self, gis, batch_size=999):
+        '''Returns a dict of {gi: taxid} for each of ``gis`` in the database,
+        looking up ``batch_size`` GIs per query'''
+        # As in gi_to_taxid(), numpy integers must be converted
+        gis = [operator.index(gi) for gi in gis]
+        taxids = {}
+        for start in range(0, len(gis), batch_size):
+            batch = gis[start:start + batch_size]
+            sql = self._GI_TAXIDS_SQL.format(', '.join('?' * len(batch)))
+            taxids.update(self._cursor.execute(sql, batch))
+        return taxids
+
     def taxon_parents(self, taxid):
-        c = self._db.cursor()
-        qry = c.execute("""SELECT parents.parent, taxa.rank, taxa.name
-                           FROM parents
-                           INNER JOIN taxa ON taxa.taxid = parents.parent
-                           WHERE parents.taxid = ?
-                           ORDER BY parents.level;""",
-                        (taxid, ))
-        for parent, rank, name in qry:
+        # Convert numpy integers before the cached lookup: they hash equal to
+        # python ints, but sqlite3 binds them as BLOBs, caching no lineage.
+        taxid = operator.index(taxid)
+        for parent, rank, name in self._lineage(taxid):
             yield (parent, rank, name)
 
+    def _ranked_lineage(self, taxid, ranks):
+        '''Returns a tuple of (taxid, rank, name) for each of a taxon and its
+        ancestors whose rank is in the frozenset ``ranks``'''
+        return tuple(taxon for taxon in self._lineage(taxid)
+                     if taxon[1] in ranks)
+
     def taxon_lineage(self, taxid, ranks=DEFAULT_RANKS):
-        ranks = set(ranks)
-        taxid = self.get_merged_taxid(taxid)
-        namedheir = OrderedDict()
-        for taxid, rank, name in self.taxon_parents(taxid):
-            if rank in ranks:
-                namedheir[rank] = {'taxid': taxid, 'name': name}
-        return namedheir
+        taxid = self.get_merged_taxid(operator.index(taxid))
+        lineage = self._ranked_lineage(taxid, frozenset(ranks))
+        return OrderedDict((rank, {'taxid': parent, 'name': name})
+                           for parent, rank, name in lineage)
 
     def sequence_lineage(self, gi, ranks=DEFAULT_RANKS):
         taxid = self.gi_to_taxid(gi)
-        return self.taxon_lineage(taxid)
-
+        return self.taxon_lineage(taxid, ranks)
@@ -0,0 +1,19 @@
+"""pytest configuration for LPI unit tests.
+"""
+from __future__ import print_function, absolute_import, division
+import os
+import tempfile
+
+import pytest
+
+
+@pytest.fixture(scope='session', autouse=True)
+def worker_tempdir(tmp_path_factory):
+    '''Give each pytest-xdist worker its own temporary directory, so tests
+    run in parallel never share temporary files'''
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'gw0')
+    tempdir = str(tmp_path_factory.mktemp('lpi-' + worker))
+    old_tempdir = tempfile.tempdir
+    tempfile.tempdir = tempdir
+    yield tempdir
+    tempfile.tempdir = old_tempdir
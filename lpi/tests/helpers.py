@@ -5,6 +5,7 @@ import atexit
 from pkg_resources import resource_filename, Requirement, ResolutionError
 from os import path
 import shutil
+import tempfile
 
 def get_data_file(filename):
     filepath = None
@@ -3,9 +3,10 @@ Test of lpi.blast module
 """
 
 from __future__ import division, absolute_import, print_function
-from nose.tools import assert_raises
-from nose import tools as nt
+import io
 import json
+import pandas as pd
+import pytest
 from lpi import blast
 from . import helpers
 
@@ -25,11 +26,27 @@ def test_seqid_type():
               {'gi': 12345, 'ref': 'WP_233421.2'})
     _do_seqid('gi|12345|ref|WP_233421.2\t',
               {'gi': 12345, 'ref': 'WP_233421.2'})
+    _do_seqid('gi|-12|ref|-WP_2', {'gi': -12, 'ref': '-WP_2'})
+    # Non-ASCII digits that int() rejects are kept as strings
+    _do_seqid(u'gi|\u00b2', {'gi': u'\u00b2'})
+    _do_seqid('WP_233421.2', {'id': 'WP_233421.2'})
+    _do_seqid('12345 ', {'id': '12345'})
 
-    with assert_raises(ValueError):
+    with pytest.raises(ValueError):
         _do_seqid('gi|12345|ref', {'gi': 12345})
 
 
+def test_seqid_equality():
+    '''Test that SeqIDs compare equal only if all their ids match.'''
+    a = blast.SeqID('gi|12345|ref|WP_233421.2|')
+    assert a == blast.SeqID('gi|12345|ref|WP_233421.2')
+    assert a != blast.SeqID('gi|12345|ref|WP_233421.1')
+    assert a != blast.SeqID('gi|12345')
+    # Parsing one ID must not affect any other
+    assert blast.SeqID('gi|12345') == blast.SeqID('gi|12345')
+    with pytest.raises(AttributeError):
+        blast.SeqID('gi|12345').ref
+
 
 def test_parse_blast_default():
     '''Test that the default tabular format columns are parsed correctly.'''
@@ -67,6 +84,43 @@ def test_parse_blast_default():
            ])
 
 
+def test_parse_blast_context():
+    '''Test that BlastFile can be used as a context manager.'''
+    fname = helpers.get_data_file('50_blast_hits.tab')
+    with blast.BlastFile(fname) as bf:
+        assert isinstance(bf, blast.BlastFile)
+        assert len(list(bf)) == len(list(blast.BlastFile(fname)))
+    assert bf.fh.closed
+
+
+def __do_test_parse_blast_frame(parsed, fname):
+    # Check a parsed data frame holds the same rows as BlastFile yields
+    expect = list(blast.BlastFile(fname))
+    assert len(parsed) == len(expect)
+    for res, expt in zip(parsed.itertuples(index=False), expect):
+        assert res.qseqid == expt.qseqid
+        assert blast.SeqID(res.sseqid) == expt.sseqid
+        assert res.length == expt.length
+        assert res.evalue == expt.evalue
+        assert res.bitscore == expt.bitscore
+
+
+def test_parse_blast_parallel():
+    '''Test that parsing a table in parallel gives every row, in order.'''
+    fname = helpers.get_data_file('50_blast_hits.tab')
+    for nworkers in [1, 2, 3, 100]:
+        parsed = blast.BlastFile(fname).parallel_iter(nworkers)
+        __do_test_parse_blast_frame(pd.concat(list(parsed)), fname)
+
+
+def test_parse_blast_dataframes():
+    '''Test that chunked and whole-table frames hold every row, in order.'''
+    fname = helpers.get_data_file('50_blast_hits.tab')
+    bf = blast.BlastFile(fname)
+    __do_test_parse_blast_frame(bf.to_dataframe(), fname)
+    __do_test_parse_blast_frame(pd.concat(list(bf.iter_chunks(7))), fname)
+
+
 def __do_test_parse_blast_queries(parser, json_sseqid_file):
     # ensure the order of the parsed queries is consistent
     parser = sorted((q, df) for q, df in parser)
@@ -95,3 +149,33 @@ def test_parse_blast_queries_filtering():
                                   filter='evalue < 1e-150'),
         helpers.get_data_file('50_blast_hits_sseqids_1e-150.json')
     )
+
+
+def test_parse_blast_queries_custom_fields():
+    '''Check that string-typed and unknown fields don't break grouping.'''
+    fields = ['qseqid', 'sseqid', 'sacc', 'stitle', 'staxids', 'custom',
+              'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+    __do_test_parse_blast_queries(
+        blast.parse_blast_groupby(helpers.get_data_file('50_blast_hits.tab'),
+                                  fields=fields),
+        helpers.get_data_file('50_blast_hits_sseqids.json')
+    )
+
+
+def test_parse_blast_queries_across_chunks():
+    '''Check that queries spanning several chunks are grouped correctly.'''
+    __do_test_parse_blast_queries(
+        blast.parse_blast_groupby(helpers.get_data_file('50_blast_hits.tab'),
+                                  chunksize=7),
+        helpers.get_data_file('50_blast_hits_sseqids.json')
+    )
+
+
+def test_parse_blast_queries_file_handle():
+    '''Check that open files are parsed as well as paths.'''
+    with open(helpers.get_data_file('50_blast_hits.tab')) as fh:
+        table = io.StringIO(fh.read())
+    __do_test_parse_blast_queries(
+        blast.parse_blast_groupby(table),
+        helpers.get_data_file('50_blast_hits_sseqids.json')
+    )
@@ -0,0 +1,224 @@
+"""
+Test of lpi.taxonomy module
+"""
+
+from __future__ import division, absolute_import, print_function
+from collections import OrderedDict
+import os
+import shutil
+import sqlite3
+import threading
+import numpy as np
+import pytest
+from lpi import taxonomy, utils
+from . import helpers
+
+
+DUMP_FILES = [
+    'taxdump.tar.gz',
+    'gi_taxid_prot.dmp.gz',
+    'gi_taxid_nucl.dmp.gz',
+]
+
+ECOLI_LINEAGE = [
+    (562, 'species', 'Escherichia coli'),
+    (561, 'genus', 'Escherichia'),
+    (543, 'family', 'Enterobacteriaceae'),
+    (91347, 'order', 'Enterobacterales'),
+    (1236, 'class', 'Gammaproteobacteria'),
+    (1224, 'phylum', 'Proteobacteria'),
+    (2, 'superkingdom', 'Bacteria'),
+    (1, 'no rank', 'root'),
+]
+
+
+@pytest.fixture
+def datadir(tmp_path, monkeypatch):
+    '''A data dir holding a tiny copy of the NCBI dumps, which the taxonomy
+    module uses in place of downloading them'''
+    for filename in DUMP_FILES:
+        shutil.copy(helpers.get_data_file(filename), str(tmp_path))
+
+    def get_data_file(filename):
+        return str(tmp_path / filename)
+
+    def read_remote_file(url):
+        # The md5 file of each dump matches our copy
+        filename = os.path.basename(url)[:-len('.md5')]
+        return '{}  {}\n'.format(utils.md5sum(get_data_file(filename)),
+                                 filename)
+
+    def download_file(url, filename):
+        raise AssertionError("Tried to download " + url)
+
+    monkeypatch.setattr(taxonomy, 'get_data_file', get_data_file)
+    monkeypatch.setattr(taxonomy, 'read_remote_file', read_remote_file)
+    monkeypatch.setattr(taxonomy, 'download_file', download_file)
+    return tmp_path
+
+
+@pytest.fixture
+def db(datadir):
+    return taxonomy.NCBITaxonomyDB(str(datadir / 'taxa.sqlite'))
+
+
+def test_taxon_parents(db):
+    '''Check lineages run from the taxon itself to the root.'''
+    assert list(db.taxon_parents(562)) == ECOLI_LINEAGE
+    assert list(db.taxon_parents(1)) == [(1, 'no rank', 'root')]
+    assert list(db.taxon_parents(620))[:2] == [
+        (620, 'genus', 'Shigella'),
+        (543, 'family', 'Enterobacteriaceae'),
+    ]
+    assert list(db.taxon_parents(99999)) == []
+    # numpy taxids must not poison the lineage cache for python ints
+    assert list(db.taxon_parents(np.int64(561))) == ECOLI_LINEAGE[1:]
+    assert list(db.taxon_parents(561)) == ECOLI_LINEAGE[1:]
+
+
+def test_taxon_lineage(db):
+    '''Check lineages are filtered to the given ranks, in lineage order.'''
+    expect = OrderedDict((rank, {'taxid': taxid, 'name': name})
+                         for taxid, rank, name in ECOLI_LINEAGE
+                         if rank in taxonomy.DEFAULT_RANKS)
+    lineage = db.taxon_lineage(562)
+    assert list(lineage.items()) == list(expect.items())
+    assert db.taxon_lineage(562, ['genus', 'phylum']) == OrderedDict([
+        ('genus', {'taxid': 561, 'name': 'Escherichia'}),
+        ('phylum', {'taxid': 1224, 'name': 'Proteobacteria'}),
+    ])
+    # Changing a returned lineage must not change later ones
+    lineage['genus']['name'] = 'changed'
+    assert db.taxon_lineage(562) == expect
+    # Nor must looking up a numpy taxid first
+    assert db.taxon_lineage(np.int64(543)) == db.taxon_lineage(543)
+    assert db.taxon_lineage(543)['family']['taxid'] == 543
+
+
+def test_merged_taxid(db):
+    '''Check merged taxids are mapped to their new taxid.'''
+    assert db.get_merged_taxid(12) == 562
+    assert db.get_merged_taxid(13) == 620
+    assert db.get_merged_taxid(562) == 562
+    assert db.taxon_lineage(12) == db.taxon_lineage(562)
+
+
+def test_gi_to_taxid(db):
+    '''Check GIs are mapped to integer taxids, singly and in bulk.'''
+    assert db.gi_to_taxid(5) == 562
+    assert db.gi_to_taxid(7) == 1224
+    assert isinstance(db.gi_to_taxid(6), int)
+    assert db.gi_to_taxid(np.int64(6)) == 561
+    with pytest.raises(KeyError):
+        db.gi_to_taxid(99)
+    assert db.gis_to_taxids([5, 7, 99]) == {5: 562, 7: 1224}
+    assert db.gis_to_taxids(np.array([5, 99])) == {5: 562}
+    assert db.gis_to_taxids(range(10), batch_size=2) == {
+        5: 562, 6: 561, 7: 1224, 8: 12,
+    }
+
+
+def test_sequence_lineage(db):
+    '''Check a GI's lineage uses the given ranks and merged taxids.'''
+    assert db.sequence_lineage(5, ['genus']) == OrderedDict([
+        ('genus', {'taxid': 561, 'name': 'Escherichia'}),
+    ])
+    assert db.sequence_lineage(8) == db.taxon_lineage(562)
+
+
+def test_reopen_db(datadir, db):
+    '''Check a complete DB is reused, and an outdated one rebuilt.'''
+    dbfile = str(datadir / 'taxa.sqlite')
+    assert db.metadata['db_complete']
+    assert db.metadata['db_version'] == taxonomy.DB_VERSION
+
+    def fail(*args):
+        raise AssertionError("Rebuilt a complete DB")
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(taxonomy.NCBITaxonomyDB, '_create_db', fail)
+        reopened = taxonomy.NCBITaxonomyDB(dbfile)
+    assert reopened.metadata == db.metadata
+    assert reopened.gi_to_taxid(5) == 562
+
+    # Outdate the DB, and leave a metadata file of an old install
+    with sqlite3.connect(dbfile) as con:
+        con.execute("UPDATE meta SET value = '0' WHERE key = 'db_version'")
+    with open(dbfile + '.info', 'w') as fh:
+        fh.write('{}')
+    reopened._db.close()
+    db._db.close()
+    rebuilt = taxonomy.NCBITaxonomyDB(dbfile)
+    assert rebuilt.metadata['db_version'] == taxonomy.DB_VERSION
+    assert rebuilt.metadata['db_complete']
+    assert not os.path.exists(dbfile + '.info')
+    assert list(rebuilt.taxon_parents(562)) == ECOLI_LINEAGE
+
+
+def test_update_md5(datadir, db, monkeypatch):
+    '''Check dump files are only rehashed if they have changed.'''
+    hashed = []
+
+    def md5sum(filename):
+        hashed.append(filename)
+        return utils.md5sum(filename)
+
+    monkeypatch.setattr(taxonomy, 'md5sum', md5sum)
+    filename = str(datadir / 'taxdump.tar.gz')
+    md5 = db.metadata['taxdump_md5']
+    db._update_md5(filename, 'taxdump_md5')
+    assert hashed == []
+    assert db.metadata['taxdump_md5'] == md5
+
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    db._update_md5(filename, 'taxdump_md5')
+    assert hashed == [filename]
+    assert db.metadata['taxdump_md5'] == md5
+
+    os.remove(filename)
+    db._update_md5(filename, 'taxdump_md5')
+    assert db.metadata['taxdump_md5'] == ''
+
+
+def test_insert_rows():
+    '''Check rows are all inserted, whether or not they fill a batch.'''
+    con = sqlite3.connect(':memory:')
+    con.execute("CREATE TABLE t (a INTEGER, b INTEGER, c TEXT)")
+    for nrows in [0, 1, 332, 333, 334, 1000]:
+        rows = [(i, i * 2, str(i)) for i in range(nrows)]
+        con.execute("DELETE FROM t")
+        taxonomy._insert_rows(con.cursor(), 't', 3, iter(rows))
+        assert con.execute("SELECT * FROM t ORDER BY a").fetchall() == rows
+
+
+def test_prefetch():
+    '''Check all items are yielded, and producer threads stop on errors and
+    when the consumer stops early.'''
+    assert sorted(taxonomy._prefetch([range(5), range(5, 10)])) == \
+        list(range(10))
+
+    closed = []
+
+    def endless():
+        try:
+            while True:
+                yield 0
+        finally:
+            closed.append(True)
+
+    def failing():
+        yield 1
+        raise ValueError("bad dump")
+
+    threads = threading.active_count()
+    with pytest.raises(ValueError):
+        list(taxonomy._prefetch([endless(), failing()], maxsize=1))
+    assert closed == [True]
+    assert threading.active_count() == threads
+
+    chunks = taxonomy._prefetch([endless()], maxsize=1)
+    next(chunks)
+    chunks.close()
+    assert closed == [True, True]
+    assert threading.active_count() == threads
@@ -0,0 +1,48 @@
+"""
+Test of lpi.utils module
+"""
+
+from __future__ import division, absolute_import, print_function
+import gzip
+import hashlib
+import pytest
+from lpi import utils
+from . import helpers
+
+
+@pytest.fixture(params=['command', 'gzip module'])
+def gzip_commands(request, monkeypatch):
+    '''Run a test with and without external decompressors'''
+    if request.param == 'gzip module':
+        monkeypatch.setattr(utils, 'GZIP_COMMANDS', [])
+
+
+def test_open_gzip(gzip_commands):
+    '''Check gzipped files are decompressed in full.'''
+    filename = helpers.get_data_file('gi_taxid_prot.dmp.gz')
+    with gzip.open(filename) as fh:
+        expect = fh.read()
+    with utils.open_gzip(filename) as fh:
+        assert fh.read() == expect
+
+
+def test_open_gzip_invalid(gzip_commands, tmp_path):
+    '''Check that a failure to decompress a file raises an error.'''
+    filename = str(tmp_path / 'invalid.gz')
+    with open(filename, 'wb') as fh:
+        fh.write(b'not gzipped')
+    with pytest.raises(IOError):
+        with utils.open_gzip(filename) as fh:
+            fh.read()
+
+
+@pytest.mark.parametrize('file_digest', [True, False])
+def test_md5sum(file_digest, monkeypatch):
+    '''Check md5sum() matches hashing the whole file at once.'''
+    if not file_digest:
+        monkeypatch.delattr(hashlib, 'file_digest', raising=False)
+    filename = helpers.get_data_file('10k_blast.tab.gz')
+    with open(filename, 'rb') as fh:
+        expect = hashlib.md5(fh.read()).hexdigest()
+    assert utils.md5sum(filename) == expect
+    assert utils.md5sum(filename, buffer_size=1000) == expect
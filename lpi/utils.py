@@ -1,7 +1,11 @@
+import gzip
 import hashlib
+import io
 import logging
 import os
 from os import path
+import shutil
+import subprocess
 import sys
 
 import requests
@@ -10,6 +14,7 @@ from six.moves.configparser import ConfigParser
 
 LOG = None
 LOGLEVEL = logging.DEBUG
+READ_BUFFER_SIZE = 8 * 1024 * 1024
 
 
 def get_config():
@@ -62,17 +67,45 @@ def get_logger(quiet=False, level=LOGLEVEL):
     return LOG
 
 
-def download_file(url, filename, chunk_size=128 * 1024):
+class _ProgressWriter(object):
+    '''Wraps a file opened for writing, logging the amount written every
+    ``interval`` bytes'''
+
+    def __init__(self, fh, interval=64 * 1024 ** 2):
+        self.fh = fh
+        self.interval = interval
+        self.written = 0
+        self._next_log = interval
+
+    def write(self, data):
+        self.fh.write(data)
+        self.written += len(data)
+        if self.written >= self._next_log:
+            get_logger().debug("%dMiB Downloaded", self.written // 1024 ** 2)
+            self._next_log += self.interval
+
+
+def _stream_to_file(src, fh, chunk_size=1024 * 1024):
+    '''Copy the readable stream ``src`` to ``fh``, reading into one reused
+    buffer rather than a new bytes object per read'''
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            break
+        fh.write(view[:size])
+
+
+def download_file(url, filename, chunk_size=1024 * 1024):
     log = get_logger()
     req = requests.get(url, stream=True)
-    cnt = 0
     log.info("Downloading %s to %s", url, filename)
     with open(filename, 'wb') as fh:
-        for chunk in req.iter_content(chunk_size):
-            cnt += len(chunk)
-            log.debug("{}MiB Downloaded".format(cnt / (1024 ** 2)))
-            fh.write(chunk)
-    log.debug("Downloaded {}".format(url))
+        # Undo any content-encoding, as iter_content() would
+        req.raw.decode_content = True
+        _stream_to_file(req.raw, _ProgressWriter(fh), chunk_size)
+    log.debug("Downloaded %s", url)
 
 
 def read_remote_file(url):
@@ -80,12 +113,65 @@ def read_remote_file(url):
     return req.text
 
 
-def md5sum(filename):
-    h = hashlib.md5()
-    with open(filename, 'rb') as fh:
+# External decompressors to try in open_gzip(), fastest first
+GZIP_COMMANDS = [
+    ['pigz', '-dc'],
+    ['gzip', '-dc'],
+]
+
+
+class DecompressorPipe(io.BufferedReader):
+    '''Reads the output of a decompressor subprocess, and raises an IOError
+    on closing if it failed'''
+
+    def __init__(self, proc, buffer_size=READ_BUFFER_SIZE):
+        super(DecompressorPipe, self).__init__(proc.stdout, buffer_size)
+        self.proc = proc
+
+    def close(self):
+        if self.closed:
+            return
+        super(DecompressorPipe, self).close()
+        # If we stop reading early, the decompressor is killed by SIGPIPE,
+        # giving a negative return code. That isn't an error.
+        if self.proc.wait() > 0:
+            raise IOError("{} exited with status {}".format(
+                self.proc.args[0], self.proc.returncode))
+
+
+def open_gzip(filename, buffer_size=READ_BUFFER_SIZE):
+    '''Open a gzipped file for reading.
+
+    The file is decompressed by the first of GZIP_COMMANDS which is installed,
+    in a separate process. Otherwise, it is decompressed by python's gzip
+    module, through a large read buffer so the decompressor is fed in few,
+    large reads.
+    '''
+    for command in GZIP_COMMANDS:
+        if shutil.which(command[0]):
+            proc = subprocess.Popen(command + [filename],
+                                    stdout=subprocess.PIPE, bufsize=0)
+            return DecompressorPipe(proc, buffer_size)
+    fh = open(filename, 'rb', buffering=buffer_size)
+    gz = gzip.GzipFile(fileobj=fh)
+    # GzipFile closes myfileobj when it is closed, as it does for files it
+    # opens itself.
+    gz.myfileobj = fh
+    return gz
+
+
+def md5sum(filename, buffer_size=READ_BUFFER_SIZE):
+    with open(filename, 'rb', buffering=0) as fh:
+        # Python >= 3.11 hashes the whole file in C
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(fh, 'md5').hexdigest()
+        h = hashlib.md5()
+        # Read into one reused buffer, rather than a new bytes per read
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
         while True:
-            chunk = fh.read(1048576)
-            h.update(chunk)
-            if not chunk:
+            size = fh.readinto(buf)
+            if not size:
                 break
+            h.update(view[:size])
     return h.hexdigest()
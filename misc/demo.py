@@ -1,66 +1,73 @@
 #!/usr/bin/env python
 from __future__ import division, print_function
 from sys import argv
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 from json import dumps
-from lpi import BlastFile, NCBITaxonomyDB, ALL_RANKS
+from lpi import SeqID, NCBITaxonomyDB, ALL_RANKS, parse_blast_groupby
 
 db = NCBITaxonomyDB()
 
-Lineage = namedtuple("Lineage", ['query', 'gi', 'genus', 'phylum', 'bitscore'])
+# Each hit's lineage is a plain tuple of (query, gi, genus, phylum, bitscore)
+GENUS, PHYLUM, BITSCORE = 2, 3, 4
 
-query = None
-lineages = []
-badgi = 0
-for hit in BlastFile(argv[1]):
-    qry = hit.qseqid
-    if query is None or query.get('name', '') != qry:
-        if query is not None:
-            #max_bitscore = max(lineages, key=lambda x: x.bitscore).bitscore
-            genus_table = dict()
-            for lineage in lineages:
-                score = lineage.bitscore
-                genus_id = lineage.genus['taxid']
-                if genus_id not in genus_table or \
-                        score > genus_table[genus_id].bitscore:
-                    genus_table[genus_id] = lineage
-            phyla = {}
-            for genus in genus_table.values():
-                phylum = genus.phylum['name']
-                if phylum not in phyla:
-                    phyla[phylum] = {'num': 0, 'score': 0.0}
-                phyla[phylum]['score'] += genus.bitscore
-                phyla[phylum]['num'] += 1
 
-            for phylum in phyla:
-                score = phyla[phylum]['score']
-                num = phyla[phylum]['num']
-                query['taxa'][phylum] = score # / num
-            query['top_taxon'] = max(query['taxa'])
+def query_lineages(qry, hits):
+    '''Look up the lineage of each of a query's hits, with one query for all
+    of their taxids and one lineage lookup per distinct taxon'''
+    gis = [SeqID(sseqid).gi for sseqid in hits.sseqid]
+    taxids = db.gis_to_taxids(set(gis))
+    taxa = {taxid: db.taxon_lineage(taxid, ALL_RANKS)
+            for taxid in set(taxids.values())}
+    query = dict(name=qry, taxa=defaultdict(float), num_unassigned=0,
+                 num_assigned=0)
+    lineages = []
+    for gi, bitscore in zip(gis, hits.bitscore.tolist()):
+        tax = taxa.get(taxids.get(gi), {})
+        if len(tax) < 3:
+            # Insufficent levels of tax tree found
+            query['num_unassigned'] += 1
+            continue
+        query['num_assigned'] += 1
+        try:
+            gen = tax['genus']
+        except KeyError:
+            gen = list(tax.values())[1]
 
-            #print(dumps(query, sort_keys=True))
-            print(query['top_taxon'])
+        try:
+            phy = tax['phylum']
+        except KeyError:
+            phy = list(tax.values())[-2]
 
-        query = dict(name=qry, taxa=defaultdict(float), num_unassigned=0,
-                     num_assigned=0)
+        lineages.append((qry, gi, gen, phy, bitscore))
+    return query, lineages
 
-    gi = hit.sseqid.gi
-    try:
-        tax = db.sequence_lineage(gi, ALL_RANKS)
-        if len(tax) < 3:
-            raise KeyError("Insufficent levels of tax tree found")
-        query['num_assigned'] += 1
-    except KeyError:
-        query['num_unassigned'] += 1
+
+badgi = 0
+for qry, hits in parse_blast_groupby(argv[1]):
+    query, lineages = query_lineages(qry, hits)
+    if not lineages:
         continue
-    try:
-        gen = tax['genus']
-    except KeyError:
-        gen = list(tax.values())[1]
+    #max_bitscore = max(lineages, key=lambda x: x[BITSCORE])[BITSCORE]
+    genus_table = dict()
+    for lineage in lineages:
+        score = lineage[BITSCORE]
+        genus_id = lineage[GENUS]['taxid']
+        if genus_id not in genus_table or \
+                score > genus_table[genus_id][BITSCORE]:
+            genus_table[genus_id] = lineage
+    phyla = {}
+    for genus in genus_table.values():
+        phylum = genus[PHYLUM]['name']
+        if phylum not in phyla:
+            phyla[phylum] = {'num': 0, 'score': 0.0}
+        phyla[phylum]['score'] += genus[BITSCORE]
+        phyla[phylum]['num'] += 1
 
-    try:
-        phy = tax['phylum']
-    except KeyError:
-        gen = list(tax.values())[-2]
+    for phylum in phyla:
+        score = phyla[phylum]['score']
+        num = phyla[phylum]['num']
+        query['taxa'][phylum] = score # / num
+    query['top_taxon'] = max(query['taxa'])
 
-    lineages.append(Lineage(qry, gi, gen, phy, hit.bitscore))
+    #print(dumps(query, sort_keys=True))
+    print(query['top_taxon'])
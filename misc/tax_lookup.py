@@ -3,7 +3,7 @@ from collections import OrderedDict
 import sqlite3
 import sys
 
-CON = sqlite3.connect("lpi-new.db")
+CON = sqlite3.connect("lpi-new.db", cached_statements=256)
 
 def get_merged_id(taxid):
     db = CON.cursor()
@@ -15,11 +15,11 @@ def get_merged_id(taxid):
 
 def get_taxid_parents(taxid):
     db = CON.cursor()
-    qry = db.execute("""SELECT parents.parent, taxa.rank, taxa.name
-                        FROM parents INNER JOIN taxa ON taxa.taxid = parents.parent
-                        WHERE parents.taxid = {}
-                        ORDER BY parents.level;
-                     """.format(taxid))
+    qry = db.execute("""SELECT parent, rank, name
+                        FROM parents
+                        WHERE taxid = ?
+                        ORDER BY level;
+                     """, (taxid, ))
     for parent, rank, name in qry:
         yield (parent, rank, name)
 
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict, deque
+import csv
 import gzip
+import io
 import sqlite3
 import sys
 import tarfile
 
+import pandas as pd
+
+# Read compressed files in large blocks, rather than the default 8KiB
+BUFFER_SIZE = 1024 * 1024
+
 
 def setup_db(dbfile="lpi.db"):
     conn = sqlite3.connect(dbfile)
+    # Don't sync to disk or journal during the load, and keep temporary data
+    # and a large page cache in memory.
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -262144")
     c = conn.cursor()
     c.execute("""CREATE TABLE merges (
                     oldid INTEGER PRIMARY KEY,
@@ -24,14 +37,17 @@ def setup_db(dbfile="lpi.db"):
                     name TEXT,
                     rank TEXT
                     )""")
+    # Each parent's rank and name are copied from taxa, so lineages can be
+    # read without a join
     c.execute("""CREATE TABLE parents (
                     taxid INTEGER,
                     parent INTEGER,
                     level INTEGER,
+                    rank TEXT,
+                    name TEXT,
                     FOREIGN KEY (taxid) REFERENCES taxa(taxid),
                     FOREIGN KEY (parent) REFERENCES taxa(taxid)
                     )""")
-    c.execute("CREATE INDEX parents_taxid ON parents (taxid)")
     conn.commit()
     return conn
 
@@ -42,88 +58,67 @@ def load_tax(tarball):
     tar = tarfile.open(tarball)
     db = CON.cursor()
 
-    def dmpfile(filename):
-        with tar.extractfile(filename) as fh:
-            for line in fh:
-                line = line.decode("utf-8")
-                fields = [x.strip() for x in line.strip('\n|').split('\t|\t')]
-                yield fields
-
-    names = {}
-    nodes = {}
-    ranks = {}
-    merges = {}
-
-    for taxon in dmpfile('names.dmp'):
-        taxid = int(taxon[0])
-        name = taxon[1]
-        nameclass = taxon[3]
-        if nameclass == "scientific name":
-            names[taxid] = name
-
-    for taxon in dmpfile('nodes.dmp'):
-        taxid = int(taxon[0])
-        parent = int(taxon[1])
-        rank = taxon[2]
-        nodes[taxid] = parent
-        ranks[taxid] = rank
-
-    for ids in dmpfile("merged.dmp"):
-        oldid, newid = map(int, ids)
-        db.execute("INSERT INTO merges VALUES (?, ?)", (oldid, newid))
+    def dmpfile(filename, fields):
+        # Fields are delimited by '\t|\t', so splitting on tabs puts field i
+        # in column 2 * i. fields is a dict of {index: (name, dtype)}.
+        with io.BufferedReader(tar.extractfile(filename), BUFFER_SIZE) as fh:
+            df = pd.read_csv(fh, sep='\t', header=None,
+                             usecols=[2 * i for i in fields],
+                             dtype={2 * i: t for i, (n, t) in fields.items()},
+                             quoting=csv.QUOTE_NONE, na_filter=False,
+                             engine='c')
+        return df.rename(columns={2 * i: n for i, (n, t) in fields.items()})
+
+    names = dmpfile('names.dmp', {0: ('taxid', 'int64'),
+                                  1: ('name', 'object'),
+                                  3: ('nameclass', 'object')})
+    names = names[names.nameclass == "scientific name"]
+    names = dict(zip(names.taxid.tolist(), names.name.tolist()))
+
+    nodes = dmpfile('nodes.dmp', {0: ('taxid', 'int64'),
+                                  1: ('parent', 'int64'),
+                                  2: ('rank', 'object')})
+    ranks = dict(zip(nodes.taxid.tolist(), nodes['rank'].tolist()))
+    nodes = dict(zip(nodes.taxid.tolist(), nodes.parent.tolist()))
+
+    merges = dmpfile('merged.dmp', {0: ('oldid', 'int64'),
+                                    1: ('newid', 'int64')})
+    db.executemany("INSERT INTO merges VALUES (?, ?)",
+                   zip(merges.oldid.tolist(), merges.newid.tolist()))
 
     print("Loaded data files")
 
-    # The tree is stored a a dict of {taxid: [taxid, parent, ..., 1]}
-    # for each parent in the tree to the root.
-    # Start with the root node.
-    tree = {1: [], }
-    for taxon, parent in nodes.items():
-        if parent in tree and taxon != 1:
-            tree[taxon] = [taxon] + tree[parent]
-        else:
-            subtree = [taxon, parent]
-            # A new list for just the new section of the tree
-            newtree = [taxon, parent]
-            thisid = parent
-            verb = False
-            while True:
-                if thisid in tree:
-                    # This will eventually be true, so long as everything
-                    # is rooted at taxid 1
-                    subtree.extend(tree[thisid])
-                    break
-                thisparent = nodes[thisid]
-                subtree.append(thisparent)
-                newtree.append(thisparent)
-
-                thisid = thisparent
-            # Add the new section of the tree
-            for i in range(len(newtree)):
-                thisid = subtree[i]
-                heirarchy = subtree[i + 1:]
-                tree[thisid] = heirarchy
-
-    print("Created tree (with", len(tree), "records)")
-    taxa = []
+    # Visit the tree breadth first from the root, so each taxon's lineage is
+    # its parent's lineage with the taxon itself added, and no part of the
+    # tree is walked more than once.
+    children = defaultdict(list)
+    for taxid, parent in nodes.items():
+        if taxid != parent:
+            children[parent].append(taxid)
+    queue = deque([(1, (1, ))])
+
     count = 0
-    for taxid, parents in tree.items():
-        taxa.append({
-                "_id": taxid,
-                "parents": parents,
-                "name": names[taxid],
-                "rank": ranks[taxid],
-            })
-        parent_items = [(taxid, par, lvl) for lvl, par in  enumerate(parents)]
-        db.executemany("INSERT INTO parents VALUES (?, ?, ?)", parent_items)
+    while queue:
+        taxid, lineage = queue.popleft()
+        for child in children.pop(taxid, ()):
+            queue.append((child, (child, ) + lineage))
+        parent_items = ((taxid, par, lvl, ranks[par], names[par])
+                        for lvl, par in enumerate(lineage))
+        db.executemany("INSERT INTO parents VALUES (?, ?, ?, ?, ?)",
+                       parent_items)
         db.execute("INSERT INTO taxa VALUES (?, ?, ?)",
                    (taxid, names[taxid], ranks[taxid]))
-        if len(taxa) > 10000:
-            count += 10
-            print("\33[2KInserted ", count, "K records", sep="", end='\r')
-            taxa = []
+        count += 1
+        if count % 10000 == 0:
+            print("\33[2KInserted ", count // 1000, "K records", sep="",
+                  end='\r')
 
     print("Loaded tree into DB")
+    # Index the parents once they are all inserted, rather than updating the
+    # index on every insert. Including the level lets lineage queries read
+    # each taxon's parents in order from the index, without sorting.
+    db.execute("CREATE INDEX parents_taxid_level ON parents (taxid, level)")
+    db.execute("ANALYZE")
     print("Finished loading taxonomy")
     CON.commit()
 
@@ -131,16 +126,15 @@ load_tax("taxdump.tar.gz")
 
 def load_gi_to_tax(file):
     db = CON.cursor()
-    with gzip.open(file) as fh:
-        pairs = []
-        for i, line in enumerate(fh):
-            gi, taxid = map(int, line.strip().split())
-            pairs.append((gi, taxid))
-            if i % 100000 == 0:
-                db.executemany("INSERT INTO sequences VALUES (?, ?)", pairs)
-                pairs[:] = []
-                print("\33[2K\r", i/1000000, "M GIs", sep='', end='\r')
-                sys.stdout.flush()
+    with io.BufferedReader(gzip.open(file), BUFFER_SIZE) as fh:
+        chunks = pd.read_csv(fh, sep=r'\s+', header=None,
+                             names=['gi', 'taxid'], dtype='int64',
+                             chunksize=1000000, engine='c')
+        for i, chunk in enumerate(chunks):
+            db.executemany("INSERT INTO sequences VALUES (?, ?)",
+                           zip(chunk.gi.tolist(), chunk.taxid.tolist()))
+            print("\33[2K\r", i + 1, "M GIs", sep='', end='\r')
+            sys.stdout.flush()
     print("\nFinished loading GIs")
     CON.commit()
 
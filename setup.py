@@ -1,56 +1,126 @@
 #!/usr/bin/env python
+import os
+import subprocess
+import sys
+
+from distutils.errors import DistutilsOptionError
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
 from setuptools.command.test import test as TestCommand
 import versioneer
 
 
+class ParallelBuildExt(build_ext):
+    '''Build extension modules on all cores, unless --parallel is given'''
+
+    def finalize_options(self):
+        build_ext.finalize_options(self)
+        if not self.parallel:
+            self.parallel = os.cpu_count() or 1
+
+
+# Fewer tests than this are run serially, as starting pytest-xdist workers
+# would take longer than running them
+MIN_PARALLEL_TESTS = 50
+# Run tests on at most this many workers, leaving two cores free
+MAX_TEST_WORKERS = 4
+
+
+def count_tests(test_dir):
+    '''Count the tests pytest collects from test_dir, or return 0 if it can't
+    collect them, leaving the test run itself to report why'''
+    try:
+        out = subprocess.check_output([sys.executable, '-m', 'pytest',
+                                       '--collect-only', '-q', test_dir])
+    except subprocess.CalledProcessError:
+        return 0
+    return sum(1 for line in out.decode().splitlines() if '::' in line)
+
+
 # Inspired by the example at https://pytest.org/latest/goodpractises.html
-class NoseCommand(TestCommand):
+class PytestCommand(TestCommand):
+    user_options = TestCommand.user_options + [
+        ('shard=', None, "only run shard i of N of the tests, as 'i/N'"),
+    ]
+
+    def initialize_options(self):
+        TestCommand.initialize_options(self)
+        self.shard = None
+
     def finalize_options(self):
         TestCommand.finalize_options(self)
         self.test_args = []
         self.test_suite = True
+        if self.shard:
+            try:
+                shard, shards = map(int, self.shard.split('/'))
+            except ValueError:
+                shard = shards = 0
+            if not 1 <= shard <= shards:
+                raise DistutilsOptionError(
+                    "--shard must be 'i/N' with 1 <= i <= N, not {!r}"
+                    .format(self.shard))
+            self.shard = (shard, shards)
 
     def run_tests(self):
-        # Run nose ensuring that argv simulates running nosetests directly
-        import nose
-        nose.run_exit(argv=['nosetests'])
+        import pytest
+        # Pass the version on to any setup.py run by the tests' processes
+        os.environ['LPI_VERSION'] = self.distribution.get_version()
+        # pytest-cov combines the coverage of any xdist workers
+        args = ['--cov=lpi', '--cov-report=xml', 'lpi/tests']
+        shards = 1
+        if self.shard:
+            # Split the tests into disjoint shards with pytest-split, so
+            # several CI jobs can each run one
+            shard, shards = self.shard
+            args += ['--splits', str(shards), '--group', str(shard)]
+        # Run the tests in parallel with pytest-xdist if there are enough,
+        # sending all tests of a module to the same worker.
+        workers = max(1, min((os.cpu_count() or 2) - 2, MAX_TEST_WORKERS))
+        if workers > 1 and \
+                count_tests('lpi/tests') // shards >= MIN_PARALLEL_TESTS:
+            args += ['-n', str(workers), '--dist=loadfile']
+        sys.exit(pytest.main(args))
 
 
 desc = """
 LPI.py: Lineage Probablity Index calculation
 """
 
-setup_requires = [
-    'nose',
-    'coverage',
-]
-
 install_requires = [
     'six',
     'requests',
     'docopt',
+    'numpy',
     'pandas',
 ]
 
 test_requires = [
     'pep8',
     'pylint',
+    'pytest',
+    'pytest-xdist',
+    'pytest-split',
+    'pytest-cov',
 ]
 
-command_classes=versioneer.get_cmdclass()
-command_classes['test'] =  NoseCommand
+# Finding the version from git runs a subprocess, so take it from the
+# environment if a parent process has already found it.
+version = os.environ.get('LPI_VERSION') or versioneer.get_version()
+
+command_classes = versioneer.get_cmdclass()
+command_classes['test'] = PytestCommand
+command_classes['build_ext'] = ParallelBuildExt
 
 setup(
     name="lpi",
     packages=['lpi', 'lpi.tests', ],
     scripts=[
     ],
-    version=versioneer.get_version(),
+    version=version,
     cmdclass=command_classes,
     install_requires=install_requires,
     tests_require=test_requires,
-    setup_requires=setup_requires,
     description=desc,
     author="Kevin Murray",
     author_email="spam@kdmurray.id.au",